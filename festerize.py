@@ -1,17 +1,132 @@
 #!/usr/bin/env python
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import contextlib
 from datetime import datetime
 from enum import IntEnum
+import functools
+import glob
+import html
+import itertools
 import logging
+import logging.handlers
 import os
 import pathlib
-import pkg_resources
+import queue
 import random
+import re
+import shutil
+import socket
 import sys
+import threading
 
-from bs4 import BeautifulSoup
 import click
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util.retry import Retry
+
+try:
+    from importlib.metadata import version
+except ImportError:  # Python < 3.8
+    from importlib_metadata import version
+
+# Seconds to wait for a connection to Fester. There's no limit on how long to
+# wait for a response, since Fester may take a while to process a large CSV.
+CONNECT_TIMEOUT = 5
+
+# Characters used to decorate the message shown for each successful upload, and
+# the borders made out of them (wide enough to frame " SUCCESS! ").
+EXTRA_SATISFACTION = ("🎉", "🎊", "✨", "💯", "😎", "✔️ ", "👍")
+SUCCESS_BORDERS = {char: char * ((4 + 10) // 2) for char in EXTRA_SATISFACTION}
+
+# Matches the message on the Fester error page telling users to upgrade.
+OUTDATED_ERROR_PATTERN = re.compile(
+    rb'id="error-message"[^>]*>([^<]*Festerize is outdated[^<]*)<'
+)
+
+
+class FesterizeError(IntEnum):
+
+    """Exit codes used by the program."""
+
+    NO_FILES_SPECIFIED = 1
+    NONEXISTENT_FILE_SPECIFIED = 2
+    NON_CSV_FILE_SPECIFIED = 3
+    FESTER_UNAVAILABLE = 4
+    FESTER_ERROR_RESPONSE = 5
+    FILE_IO_ERROR = 6
+    DUPLICATE_FILENAME_SPECIFIED = 7
+
+
+@contextlib.contextmanager
+def cached_dns():
+    """Caches the results of socket.getaddrinfo while the context is active.
+
+    This way, Fester's hostname is resolved once per run rather than every
+    time a new connection to it is opened. The cached function is yielded so
+    that callers can clear the cache if a request fails.
+    """
+    getaddrinfo = socket.getaddrinfo
+    cached_getaddrinfo = functools.lru_cache(maxsize=32)(getaddrinfo)
+    socket.getaddrinfo = cached_getaddrinfo
+    try:
+        yield cached_getaddrinfo
+    finally:
+        socket.getaddrinfo = getaddrinfo
+
+
+def expand_src(src):
+    """Expands any globs in SRC that the shell didn't.
+
+    Paths that exist are used as-is, even if they look like globs (e.g.,
+    `box[1].csv`), since the shell has already expanded them. The matches for
+    each glob are sorted, and a glob that matches nothing is kept as-is so
+    that it gets reported as a missing file.
+    """
+    for pattern in src:
+        if os.path.exists(pattern):
+            yield pattern
+        else:
+            yield from sorted(glob.glob(pattern)) or [pattern]
+
+
+def parse_error_cause(error_page, encoding=None):
+    """Gets the cause of an error from an error page returned by Fester.
+
+    Clients that are out of date are the most common cause of errors, so that
+    message is found without parsing the whole page. Unless the page's
+    encoding is given, that message is decoded as UTF-8 (which is what Fester
+    uses), and the rest of the page is left to the parser to detect.
+    """
+    outdated_match = OUTDATED_ERROR_PATTERN.search(error_page)
+    if outdated_match is not None:
+        return html.unescape(outdated_match.group(1).decode(encoding or "utf-8"))
+
+    # Imported here since it's slow to load and only needed for errors.
+    from bs4 import BeautifulSoup
+
+    error_page_soup = BeautifulSoup(error_page, features="lxml", from_encoding=encoding)
+    try:
+        # Fester error page via Vert.x
+        return error_page_soup.find(id="error-message").get_text()
+    except AttributeError:
+        # nginx error page with response status code and message in title
+        return f"{error_page_soup.title.string} - nginx"
+
+
+def is_unreachable(e):
+    """Returns whether a requests exception means Fester couldn't be reached.
+
+    This is the case when no connection could be made at all, as opposed to
+    one that failed partway through an upload.
+    """
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+
+    # requests wraps urllib3's MaxRetryError, which has the underlying error.
+    reason = getattr(e.args[0], "reason", None) if e.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
 
 
 @click.command()
@@ -56,7 +171,19 @@ intended to be viewed with Universal Viewer.""",
     help="""Festerize immediately exits with an error code if Fester responds
 with an error, or if a user specifies on the command line a file that does not
 exist or a file that does not have a .csv filename extension. The rest of the
-files on the command line (if any) will remain unprocessed.""",
+files on the command line (if any) will remain unprocessed, though with
+--jobs greater than 1, uploads that are already in progress are allowed to
+finish.""",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="""Number of CSV files to upload to Fester at the same time. Only use
+more than 1 if none of the files depend on each other, since they may then be
+festerized in any order.""",
 )
 @click.option(
     "--loglevel",
@@ -73,6 +200,7 @@ def festerize(
     iiifhost,
     metadata_update,
     strict_mode,
+    jobs,
     loglevel,
 ):
     """Uploads CSV files to the Fester IIIF manifest service for processing.
@@ -117,77 +245,74 @@ def festerize(
             - Solution: add a work row to the CSV and re-run `festerize` with
             it, or run `festerize` with another CSV that contains the work row
 
+    Files are festerized one at a time, in the order that they're given on the
+    command line. With `--jobs` greater than 1, several files are uploaded at
+    the same time and may reach Fester in any order, so the files in a single
+    run must not depend on each other (e.g., a collection CSV and the CSVs of
+    its works must be festerized in separate runs).
+
     Arguments:
 
         SRC is either a path to a CSV file or a Unix-style glob like '*.csv'.
     """
 
-    class FesterizeError(IntEnum):
-
-        """Exit codes used by the program."""
-
-        NO_FILES_SPECIFIED = 1
-        NONEXISTENT_FILE_SPECIFIED = 2
-        NON_CSV_FILE_SPECIFIED = 3
-        FESTER_UNAVAILABLE = 4
-        FESTER_ERROR_RESPONSE = 5
-        FILE_IO_ERROR = 6
-
-    festerize_version = pkg_resources.require("Festerize")[0].version
+    festerize_version = version("Festerize")
 
     if len(src) == 0:
         click.echo("Please provide one or more CSV files", err=True)
         sys.exit(FesterizeError.NO_FILES_SPECIFIED)
 
     if not os.path.exists(out):
-        click.echo("Output directory {} not found, creating it.".format(out))
+        click.echo(f"Output directory {out} not found, creating it.")
         os.makedirs(out)
     else:
         click.confirm(
-            "Output directory {} found, should we continue? YES might overwrite any existing output files.".format(
-                out
-            ),
+            f"Output directory {out} found, should we continue? YES might overwrite any existing output files.",
             abort=True,
         )
 
     # Logging setup.
     started = datetime.now()
-    logfile_path = os.path.join(
-        out, "{}.log".format(started.strftime("%Y-%m-%d--%H-%M-%S"))
+    logfile_path = os.path.join(out, f"{started:%Y-%m-%d--%H-%M-%S}.log")
+
+    # Write to the log file on a background thread so that logging never
+    # blocks the uploads. Whatever is still queued is written out once the
+    # command finishes, however it exits.
+    logfile_handler = logging.FileHandler(logfile_path, mode="w")
+    logfile_handler.setFormatter(
+        logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
     )
-    logging.basicConfig(
-        filename=logfile_path,
-        filemode="w",
-        level=loglevel,
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    )
-    extra_satisfaction = ["🎉", "🎊", "✨", "💯", "😎", "✔️ ", "👍"]
-
-    logging.info("STARTING at {}...".format(started.strftime("%Y-%m-%d %H:%M:%S")))
-
-    # HTTP request URLs.
-    get_status_url = server + "/fester/status"
-    post_csv_url = server + "/collections"
-
-    # HTTP request headers.
-    request_headers = {"User-Agent": "{}/{}".format("Festerize", festerize_version)}
-
-    # If Fester is unavailable, abort.
-    try:
-        s = requests.get(get_status_url, headers=request_headers)
-        s.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        error_msg = "Fester IIIF manifest service unavailable: {}".format(str(e))
-        click.echo(error_msg, err=True)
-        logging.error(error_msg)
-        sys.exit(FesterizeError.FESTER_UNAVAILABLE)
-
-    for pathstring in src:
+    log_queue = queue.Queue(-1)
+    log_listener = logging.handlers.QueueListener(log_queue, logfile_handler)
+    log_queue_handler = logging.handlers.QueueHandler(log_queue)
+    root_logger = logging.getLogger()
+    root_logger.setLevel(loglevel)
+    root_logger.addHandler(log_queue_handler)
+    log_listener.start()
+
+    # Callbacks run in reverse order, so the handler is detached before the
+    # listener drains the queue.
+    ctx = click.get_current_context()
+    ctx.call_on_close(log_listener.stop)
+    ctx.call_on_close(lambda: root_logger.removeHandler(log_queue_handler))
+
+    logging.info(f"STARTING at {started:%Y-%m-%d %H:%M:%S}...")
+
+    # Check every file before uploading anything, so that strict mode fails
+    # before any network work.
+    csv_pathstrings = []
+
+    # Each returned CSV is saved under its original filename, so only one file
+    # with a given name can be festerized per run. Maps each of those names to
+    # the path given for the file that will be uploaded and its resolved path.
+    csv_sources = {}
+
+    for pathstring in expand_src(src):
         csv_filepath = pathlib.Path(pathstring)
         csv_filename = csv_filepath.name
 
         if not csv_filepath.exists():
-            error_msg = "File {} does not exist".format(csv_filename)
+            error_msg = f"File {csv_filename} does not exist"
             click.echo(error_msg, err=True)
             logging.error(error_msg)
 
@@ -195,85 +320,228 @@ def festerize(
                 sys.exit(FesterizeError.NONEXISTENT_FILE_SPECIFIED)
 
         # Only works with CSV files that have the proper extension.
-        elif csv_filepath.suffix == ".csv":
-            click.echo("Uploading {} to {}".format(csv_filename, post_csv_url))
-
-            # Upload the file.
-            files = {
-                "file": (
-                    pathstring,
-                    open(pathstring, "rb"),
-                    "text/csv",
-                    {"Expires": "0"},
-                )
-            }
-            payload = [("iiif-version", "v{}".format(iiif_api_version))]
-            if iiifhost is not None:
-                payload.append(("iiif-host", iiifhost))
-            if metadata_update:
-                payload.append(("metadata-update", True))
-            r = requests.post(
-                post_csv_url, headers=request_headers, files=files, data=payload
-            )
-
-            # Handle the response.
-            if r.status_code == 201:
-                click.echo("Uploaded {} successfully".format(csv_filename))
-
-                # Check the returned CSV
-                content_length_header_key = "Content-Length"
-                click.echo(
-                    "{}: {}".format(
-                        content_length_header_key, r.headers[content_length_header_key]
-                    )
-                )
-
-                # Save the result CSV to the output directory.
-                with open(os.path.join(out, csv_filename), "wb") as f:
-                    num_bytes_written = f.write(r.content)
-
-                if num_bytes_written is 0:
-                    error_msg = "Failed to write data to {}".format(csv_filename)
-                    click.echo(error_msg, err=True)
-                    logging.error(error_msg)
-
-                    if strict_mode:
-                        sys.exit(FesterizeError.FILE_IO_ERROR)
-                else:
-                    # Send an awesome message to the user.
-                    border_char = extra_satisfaction[
-                        random.randint(0, len(extra_satisfaction) - 1)
-                    ]
-                    border_length = (4 + 10) // 2
-
-                    click.echo(border_char * border_length)
-                    click.echo("{} SUCCESS! {}".format(border_char, border_char))
-                    click.echo(border_char * border_length)
-            else:
-                error_page_soup = BeautifulSoup(r.text, features="html.parser")
-                try:
-                    # Fester error page via Vert.x
-                    error_cause = error_page_soup.find(id="error-message").get_text()
-                except AttributeError:
-                    # nginx error page with response status code and message in title
-                    error_cause = "{} - {}".format(
-                        error_page_soup.title.string, "nginx"
-                    )
-
-                error_msg = "Failed to upload {}: {} (HTTP {})".format(
-                    csv_filename, error_cause, r.status_code
+        elif csv_filepath.suffix == ".csv" and csv_filepath.is_file():
+            realpath = os.path.realpath(pathstring)
+
+            if csv_filename not in csv_sources:
+                csv_sources[csv_filename] = (pathstring, realpath)
+                csv_pathstrings.append(pathstring)
+
+            # Files given more than once (e.g., by overlapping globs) are only
+            # uploaded once.
+            elif csv_sources[csv_filename][1] != realpath:
+                error_msg = (
+                    f"File {pathstring} has the same name as "
+                    f"{csv_sources[csv_filename][0]}, so their output would collide"
                 )
                 click.echo(error_msg, err=True)
                 logging.error(error_msg)
 
                 if strict_mode:
-                    sys.exit(FesterizeError.FESTER_ERROR_RESPONSE)
+                    sys.exit(FesterizeError.DUPLICATE_FILENAME_SPECIFIED)
         else:
-            error_msg = "File {} is not a CSV".format(csv_filename)
+            error_msg = f"File {csv_filename} is not a CSV"
             click.echo(error_msg, err=True)
             logging.error(error_msg)
 
             if strict_mode:
                 sys.exit(FesterizeError.NON_CSV_FILE_SPECIFIED)
 
-    logging.info("DONE at {}.".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    # HTTP request URLs.
+    post_csv_url = server + "/collections"
+
+    # HTTP request form data, which is the same for every file. It's shared by
+    # all of the upload threads, so it's made immutable.
+    form_fields = [("iiif-version", f"v{iiif_api_version}")]
+    if iiifhost is not None:
+        form_fields.append(("iiif-host", iiifhost))
+    if metadata_update:
+        form_fields.append(("metadata-update", "true"))
+    payload = tuple(form_fields)
+
+    # HTTP request headers. These are added to the session's defaults, which
+    # already ask Fester to compress the CSVs it returns.
+    request_headers = {"User-Agent": f"Festerize/{festerize_version}"}
+
+    # Serializes console output from the upload threads.
+    echo_lock = threading.Lock()
+
+    def echo(message, err=False):
+        with echo_lock:
+            click.echo(message, err=err)
+
+    # Set once an upload finds that Fester can't be reached.
+    fester_unavailable = threading.Event()
+
+    def handle_response(r, csv_filename):
+        """Saves the CSV returned by Fester, or reports the error it sent back.
+
+        Returns the FesterizeError describing what went wrong, or None if the
+        file was festerized successfully.
+        """
+        if r.status_code == 201:
+            # Check the returned CSV. Chunked responses have no Content-Length.
+            content_length_header_key = "Content-Length"
+            content_length = r.headers.get(content_length_header_key)
+
+            # Stream the result CSV straight to the output directory, without
+            # holding all of it in memory first.
+            with open(os.path.join(out, csv_filename), "wb") as f:
+                r.raw.decode_content = True
+                shutil.copyfileobj(r.raw, f, 1024 * 1024)
+                num_bytes_written = f.tell()
+
+            if num_bytes_written == 0:
+                error_msg = f"Failed to write data to {csv_filename}"
+                echo(error_msg, err=True)
+                logging.error(error_msg)
+                return FesterizeError.FILE_IO_ERROR
+
+            # Content-Length counts the bytes as sent, before any decoding, so
+            # compare it with what was read off the wire rather than written.
+            num_bytes_received = r.raw.tell()
+            if content_length is not None and num_bytes_received != int(content_length):
+                warning_msg = (
+                    f"Received {num_bytes_received} of {content_length} bytes "
+                    f"of {csv_filename}; the saved CSV may be incomplete"
+                )
+                echo(warning_msg, err=True)
+                logging.warning(warning_msg)
+
+            success_msg_lines = [f"Uploaded {csv_filename} successfully"]
+            if content_length is not None:
+                success_msg_lines.append(
+                    f"{content_length_header_key}: {content_length}"
+                )
+
+            # Send an awesome message to the user.
+            border_char = random.choice(EXTRA_SATISFACTION)
+            border = SUCCESS_BORDERS[border_char]
+            success_msg_lines += [
+                border,
+                f"{border_char} SUCCESS! {border_char}",
+                border,
+            ]
+
+            # Echo everything at once so that it isn't interleaved with the
+            # output of the other upload threads.
+            echo("\n".join(success_msg_lines))
+            return None
+
+        # Only pass on the page's encoding if it was declared, since otherwise
+        # requests falls back to ISO-8859-1 for any text response.
+        content_type = r.headers.get("Content-Type", "")
+        encoding = r.encoding if "charset" in content_type else None
+        error_cause = parse_error_cause(r.content, encoding)
+
+        error_msg = (
+            f"Failed to upload {csv_filename}: {error_cause} (HTTP {r.status_code})"
+        )
+        echo(error_msg, err=True)
+        logging.error(error_msg)
+        return FesterizeError.FESTER_ERROR_RESPONSE
+
+    def festerize_csv(pathstring):
+        """Uploads a single CSV to Fester and saves the CSV that it returns.
+
+        Returns the FesterizeError describing what went wrong, or None if the
+        file was festerized successfully.
+        """
+        csv_filename = os.path.basename(pathstring)
+
+        echo(f"Uploading {csv_filename} to {post_csv_url}")
+
+        # Upload the file, making sure that it gets closed afterward.
+        with open(pathstring, "rb") as csv_file:
+            files = {"file": (csv_filename, csv_file, "text/csv", {"Expires": "0"})}
+            try:
+                r = session.post(
+                    post_csv_url,
+                    files=files,
+                    data=payload,
+                    stream=True,
+                    timeout=(CONNECT_TIMEOUT, None),
+                )
+            except requests.exceptions.RequestException as e:
+                if not is_unreachable(e):
+                    error_msg = f"Failed to upload {csv_filename}: {e}"
+                    echo(error_msg, err=True)
+                    logging.error(error_msg)
+                    return FesterizeError.FESTER_ERROR_RESPONSE
+
+                # Resolve Fester's hostname again in case its address changed.
+                getaddrinfo.cache_clear()
+
+                # Every upload that's running will fail the same way, so only
+                # the first one reports it.
+                with echo_lock:
+                    already_reported = fester_unavailable.is_set()
+                    fester_unavailable.set()
+                if not already_reported:
+                    error_msg = f"Fester IIIF manifest service unavailable: {e}"
+                    echo(error_msg, err=True)
+                    logging.error(error_msg)
+                return FesterizeError.FESTER_UNAVAILABLE
+
+        # Release the connection once the response has been handled, so that
+        # the next upload reuses it instead of opening (and handshaking) a new
+        # one. If the response wasn't read in full, the connection is closed.
+        with r:
+            try:
+                return handle_response(r, csv_filename)
+            except (
+                requests.exceptions.RequestException,
+                urllib3.exceptions.HTTPError,
+            ) as e:
+                # The connection failed while the response was being read.
+                error_msg = f"Failed to receive the updated {csv_filename}: {e}"
+                echo(error_msg, err=True)
+                logging.error(error_msg)
+                return FesterizeError.FESTER_ERROR_RESPONSE
+
+    # Reuse connections to Fester across all of the uploads.
+    with requests.Session() as session, cached_dns() as getaddrinfo:
+        session.headers.update(request_headers)
+
+        # Size the connection pool so that every upload thread can keep its
+        # own connection alive, and retry requests that fail while Fester (or
+        # the proxy in front of it) is restarting. If Fester still responds
+        # with an error after the last retry, it's handled like any other.
+        retry = Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["POST"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_maxsize=jobs, max_retries=retry)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        # Upload up to `jobs` files at a time, in order. A file is only started
+        # once an earlier upload has finished and its result has been checked,
+        # so nothing new is uploaded after an error that should stop the run.
+        remaining = iter(csv_pathstrings)
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            running = {
+                executor.submit(festerize_csv, p)
+                for p in itertools.islice(remaining, jobs)
+            }
+
+            while running:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    error = future.result()
+
+                    # There's no point in uploading anything else if Fester is
+                    # unavailable, so stop then even if not in strict mode.
+                    if error is FesterizeError.FESTER_UNAVAILABLE or (
+                        error is not None and strict_mode
+                    ):
+                        sys.exit(error)
+
+                for p in itertools.islice(remaining, len(done)):
+                    running.add(executor.submit(festerize_csv, p))
+
+    logging.info(f"DONE at {datetime.now():%Y-%m-%d %H:%M:%S}.")
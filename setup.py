@@ -6,7 +6,14 @@ setup(
     name="Festerize",
     version="0.4.2",
     py_modules=["festerize"],
-    install_requires=["beautifulsoup4", "click", "requests"],
+    install_requires=[
+        "beautifulsoup4",
+        "click",
+        "importlib-metadata; python_version < '3.8'",
+        "lxml",
+        "requests",
+        "urllib3>=1.26",
+    ],
     entry_points="""
         [console_scripts]
         festerize=festerize:festerize
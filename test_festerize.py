@@ -1,8 +1,23 @@
+import http.server
 import re
+import socket
+import threading
 
+from bs4 import BeautifulSoup
 from click.testing import CliRunner
+import pytest
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
 
-from festerize import festerize
+from festerize import (
+    OUTDATED_ERROR_PATTERN,
+    FesterizeError,
+    cached_dns,
+    expand_src,
+    festerize,
+    is_unreachable,
+    parse_error_cause,
+)
 
 
 def test_cli_help():
@@ -27,3 +42,184 @@ def test_cli_version():
 
     assert result.exit_code == 0
     assert re.match("Festerize v", result.output) is not None
+
+
+def test_cli_strict_mode_invalid_files(tmp_path, monkeypatch):
+    """Tests that --strict-mode rejects invalid files before contacting Fester."""
+    monkeypatch.chdir(tmp_path)
+    for filename in ["works.csv", "notes.txt"]:
+        (tmp_path / filename).write_text("Item ARK,Object Type\n")
+
+    # Nothing listens on this port, so reaching Fester would be an error too.
+    args = ["-v", "2", "--server", "http://127.0.0.1:9", "--strict-mode"]
+
+    result = CliRunner().invoke(festerize, args + ["works.csv", "missing.csv"])
+    assert result.exit_code == FesterizeError.NONEXISTENT_FILE_SPECIFIED
+
+    result = CliRunner().invoke(festerize, args + ["*.csv", "*.txt"], input="y\n")
+    assert result.exit_code == FesterizeError.NON_CSV_FILE_SPECIFIED
+
+
+def test_expand_src(tmp_path, monkeypatch):
+    """Tests that existing paths aren't globbed and that globs are sorted."""
+    monkeypatch.chdir(tmp_path)
+    for filename in ["box[1].csv", "box1.csv", "a.csv"]:
+        (tmp_path / filename).write_text("Item ARK,Object Type\n")
+
+    assert list(expand_src(["box[1].csv"])) == ["box[1].csv"]
+    assert list(expand_src(["*.csv", "missing.csv"])) == [
+        "a.csv",
+        "box1.csv",
+        "box[1].csv",
+        "missing.csv",
+    ]
+
+
+def test_cli_strict_mode_duplicate_filenames(tmp_path, monkeypatch):
+    """Tests that --strict-mode rejects different files with the same name."""
+    monkeypatch.chdir(tmp_path)
+    for dirname in ["a", "b"]:
+        (tmp_path / dirname).mkdir()
+        (tmp_path / dirname / "works.csv").write_text("Item ARK,Object Type\n")
+
+    result = CliRunner().invoke(
+        festerize,
+        ["-v", "2", "--server", "http://127.0.0.1:9", "--strict-mode"]
+        + ["a/works.csv", "b/works.csv"],
+    )
+    assert result.exit_code == FesterizeError.DUPLICATE_FILENAME_SPECIFIED
+
+
+def test_parse_error_cause():
+    """Tests that the outdated-client shortcut matches a full parse of the page."""
+    error_page = (
+        "<html><head><title>400 Bad Request</title></head><body>"
+        '<p id="error-message">Festerize is outdated, please upgrade &amp; '
+        "don&#39;t forget to re-run it (café)</p></body></html>"
+    )
+
+    for encoding in [None, "latin-1"]:
+        error_page_bytes = error_page.encode(encoding or "utf-8")
+        error_page_soup = BeautifulSoup(
+            error_page_bytes, features="lxml", from_encoding=encoding
+        )
+
+        assert OUTDATED_ERROR_PATTERN.search(error_page_bytes) is not None
+        assert parse_error_cause(error_page_bytes, encoding) == (
+            error_page_soup.find(id="error-message").get_text()
+        )
+
+    nginx_error_page = b"<html><head><title>502 Bad Gateway</title></head></html>"
+    assert parse_error_cause(nginx_error_page) == "502 Bad Gateway - nginx"
+
+
+def test_cli_log_file_per_run(tmp_path, monkeypatch):
+    """Tests that each run in the same process writes to its own log file."""
+    monkeypatch.chdir(tmp_path)
+
+    for out in ["first", "second"]:
+        result = CliRunner().invoke(
+            festerize,
+            ["-v", "2", "--server", "http://127.0.0.1:9", "--out", out]
+            + ["--strict-mode", "missing.csv"],
+        )
+        assert result.exit_code == FesterizeError.NONEXISTENT_FILE_SPECIFIED
+
+        (logfile_path,) = (tmp_path / out).glob("*.log")
+        assert re.search(
+            r"^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} - root - ERROR - "
+            r"File missing\.csv does not exist$",
+            logfile_path.read_text(),
+            re.MULTILINE,
+        )
+
+
+class ChunkedFesterHandler(http.server.BaseHTTPRequestHandler):
+    """Mimics Fester, returning the uploaded CSV without a Content-Length."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        csv = b"Item ARK,Object Type,IIIF Manifest URL\n"
+
+        self.send_response(201)
+        self.send_header("Content-Type", "text/csv")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.wfile.write(b"%x\r\n%s\r\n0\r\n\r\n" % (len(csv), csv))
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def chunked_fester():
+    """Runs a ChunkedFesterHandler server, yielding its URL."""
+    server = http.server.HTTPServer(("127.0.0.1", 0), ChunkedFesterHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_cli_chunked_response(tmp_path, monkeypatch, chunked_fester):
+    """Tests saving a returned CSV that was sent without a Content-Length."""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "works.csv").write_text("Item ARK,Object Type\n")
+
+    result = CliRunner().invoke(
+        festerize, ["-v", "2", "--server", chunked_fester, "--strict-mode", "works.csv"]
+    )
+
+    assert result.exit_code == 0
+    assert "Content-Length" not in result.output
+    assert (tmp_path / "output" / "works.csv").read_text() == (
+        "Item ARK,Object Type,IIIF Manifest URL\n"
+    )
+
+
+def test_is_unreachable():
+    """Tests telling a Fester that can't be reached from a failed upload."""
+
+    def connection_error(reason):
+        return requests.exceptions.ConnectionError(
+            MaxRetryError(None, "/collections", reason)
+        )
+
+    assert is_unreachable(connection_error(NewConnectionError(None, "refused")))
+    assert is_unreachable(requests.exceptions.ConnectTimeout())
+
+    # The connection was reset partway through an upload.
+    reset = ProtocolError("Connection aborted.", ConnectionResetError())
+    assert not is_unreachable(connection_error(reset))
+    assert not is_unreachable(requests.exceptions.ReadTimeout())
+
+
+def test_cached_dns(monkeypatch):
+    """Tests that lookups are cached only while the context is active."""
+    lookups = []
+
+    def getaddrinfo(host, port, *args, **kwargs):
+        lookups.append(host)
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("192.0.2.1", port))]
+
+    monkeypatch.setattr(socket, "getaddrinfo", getaddrinfo)
+
+    with cached_dns() as cached_getaddrinfo:
+        assert socket.getaddrinfo is cached_getaddrinfo
+        socket.getaddrinfo("fester.example", 443)
+        socket.getaddrinfo("fester.example", 443)
+        assert lookups == ["fester.example"]
+
+        cached_getaddrinfo.cache_clear()
+        socket.getaddrinfo("fester.example", 443)
+        assert lookups == ["fester.example", "fester.example"]
+
+    assert socket.getaddrinfo is getaddrinfo
+
+    with pytest.raises(RuntimeError):
+        with cached_dns():
+            raise RuntimeError
+
+    assert socket.getaddrinfo is getaddrinfo